@@ -1,15 +1,56 @@
 from openai import OpenAI
+import argparse
+import io
+import json
 import os
+import time
 from dotenv import load_dotenv
+from utils.translation_cache import TranslationCache
 load_dotenv()
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+TRANSLATION_MODEL = os.environ.get("TRANSLATION_MODEL", "gpt-4o-mini")
+BATCH_POLL_INTERVAL = 10  # Seconds to wait between Batch API status checks
+EMBEDDING_MODEL = "text-embedding-3-small"  # Model used by the semantic translation cache
 
 client = OpenAI(
     api_key=OPENAI_API_KEY
 )
 
-def translate_text(text, source_lang="Spanish", target_lang="English"):
+# Cache of previous translations, shared by translate_text and translate_texts. The namespace
+# names the prompt of _build_messages, its version is bumped whenever that prompt changes.
+cache = TranslationCache(f"openai:{TRANSLATION_MODEL}:simple-agent-v1")
+
+def _build_messages(text, source_lang, target_lang):
+    """
+    Builds the chat messages used to request a translation.
+    """
+    return [
+        {"role": "system", "content": f"You are a translator that translates {source_lang} to {target_lang}."},
+        {"role": "user", "content": f"Translate the following text: '{text}'"}
+    ]
+
+def _embed_texts(texts):
+    """
+    Computes the embeddings used by the semantic cache, or None for each text on failure.
+    """
+    try:
+        response = client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+        return [item.embedding for item in response.data]
+    except Exception:
+        return [None] * len(texts)
+
+def _request_translation(text, source_lang, target_lang):
+    """
+    Sends a single synchronous translation request to OpenAI's GPT-4 API.
+    """
+    response = client.chat.completions.create(
+        model=TRANSLATION_MODEL,
+        messages=_build_messages(text, source_lang, target_lang),
+    )
+    return response.choices[0].message.content
+
+def translate_text(text, source_lang, target_lang):
     """
     Translates a given text from one language to another using OpenAI's GPT-4 API.
 
@@ -21,25 +62,129 @@ def translate_text(text, source_lang="Spanish", target_lang="English"):
     Returns:
         str: The translated text provided by GPT-4.
     """
+    translation = cache.get(text, source_lang, target_lang)
+    if translation is not None:
+        return translation
+
+    [embedding] = _embed_texts([text])
+    if embedding is not None:
+        translation = cache.get_similar(embedding, source_lang, target_lang)
+        if translation is not None:
+            return translation
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": f"You are a translator that translates {source_lang} to {target_lang}."},
-                {"role": "user", "content": f"Translate the following text: '{text}'"}
-            ],
-        )
-        return response.choices[0].message.content
+        translation = _request_translation(text, source_lang, target_lang)
+        cache.set(text, source_lang, target_lang, translation, embedding)
+        return translation
     except Exception as e:
         return f"Error: {str(e)}"
 
+def translate_texts(texts, source_lang, target_lang):
+    """
+    Translates a list of texts in bulk using OpenAI's Batch API.
+
+    The Batch API runs the requests asynchronously within a 24h window at a lower cost
+    than the synchronous endpoint, so it suits workloads where results are not needed
+    instantly. Texts found in the cache are not resubmitted, and a single remaining text
+    falls through to the synchronous endpoint.
+
+    Args:
+        texts (list[str]): The texts to translate.
+        source_lang (str): The source language of the texts.
+        target_lang (str): The target language for the translations.
+
+    Returns:
+        list[str]: The translated texts, in the same order as the input.
+    """
+    translations = [cache.get(text, source_lang, target_lang) for text in texts]
+    misses = [i for i, translation in enumerate(translations) if translation is None]
+    if not misses:
+        return translations
+
+    embeddings = _embed_texts([texts[i] for i in misses])
+    for i, embedding in zip(misses, embeddings):
+        if embedding is not None:
+            translations[i] = cache.get_similar(embedding, source_lang, target_lang)
+
+    pending = [(i, embedding) for i, embedding in zip(misses, embeddings) if translations[i] is None]
+    if pending:
+        if len(pending) == 1:
+            try:
+                results = [_request_translation(texts[pending[0][0]], source_lang, target_lang)]
+            except Exception as e:
+                results = [f"Error: {str(e)}"]
+        else:
+            results = _batch_translations([texts[i] for i, _ in pending], source_lang, target_lang)
+
+        for (i, embedding), translation in zip(pending, results):
+            translations[i] = translation
+            if not translation.startswith("Error: "):
+                cache.set(texts[i], source_lang, target_lang, translation, embedding)
+
+    return translations
+
+def _batch_translations(texts, source_lang, target_lang):
+    """
+    Submits the texts as one Batch API job and waits for the results.
+    """
+    try:
+        # Build the batch input file in memory, one chat completion request per line
+        lines = [
+            json.dumps({
+                "custom_id": f"t{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": TRANSLATION_MODEL,
+                    "messages": _build_messages(text, source_lang, target_lang),
+                },
+            })
+            for i, text in enumerate(texts)
+        ]
+        batch_input = io.BytesIO("\n".join(lines).encode("utf-8"))
+
+        input_file = client.files.create(file=("translations.jsonl", batch_input), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+
+        # Wait for the batch to reach a terminal state
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch = client.batches.retrieve(batch.id)
+
+        if batch.status != "completed":
+            raise Exception(f"Batch {batch.id} finished with status '{batch.status}'")
+
+        # Map each result back to its input through the custom_id
+        translations = {}
+        if batch.output_file_id:
+            output = client.files.content(batch.output_file_id).text
+            for line in output.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    translations[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+                else:
+                    translations[result["custom_id"]] = f"Error: {result.get('error') or response.get('body')}"
+
+        return [translations.get(f"t{i}", "Error: no result returned by the batch") for i in range(len(texts))]
+    except Exception as e:
+        return [f"Error: {str(e)}"] * len(texts)
+
 if __name__ == "__main__":
-    source_lang = "Spanish"
-    target_lang = "English"
-    text_to_translate = f"Hola, qué tal?"
+    parser = argparse.ArgumentParser(description="Translate a text with OpenAI's GPT-4 API.")
+    parser.add_argument("text", nargs="?", default="Hola, qué tal?", help="Text to translate.")
+    parser.add_argument("--src", default="Spanish", help="Source language of the text (default: Spanish).")
+    parser.add_argument("--tgt", default="English", help="Target language of the translation (default: English).")
+    args = parser.parse_args()
 
-    print("Translating text:", text_to_translate)
+    print("Translating text:", args.text)
 
-    translation = translate_text(text_to_translate, source_lang=source_lang, target_lang=target_lang)
+    translation = translate_text(args.text, source_lang=args.src, target_lang=args.tgt)
 
-    print("Translation:", translation)
\ No newline at end of file
+    print("Translation:", translation)
@@ -11,24 +11,91 @@ Functions:
     main(): Initializes the payment system and the translator agent, then starts the subscription task.
 """
 
-from openai import OpenAI
+import functools
 import os
-from dotenv import load_dotenv
 import asyncio
-from payments_py import Payments, Environment
 from payments_py.data_models import AgentExecutionStatus, TaskLog
+from utils import fast_json
+from utils.single_flight import SingleFlight
+from utils.tokens import count_tokens, get_encoding
 
-# Load environment variables from the .env file
-load_dotenv()
+# Load environment variables from the .env file when running the agent
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # Constants for API keys and environment setup
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 ENVIRONMENT = os.environ.get("NVM_ENVIRONMENT")
 NVM_API_KEY = os.environ.get("NVM_API_KEY")
 AGENT_DID = os.environ.get("AGENT_DID")
+TRANSLATION_MODEL = os.environ.get("TRANSLATION_MODEL", "gpt-4o-mini")
+
+# Maximum number of batches of steps processed concurrently by the agent
+AGENT_CONCURRENCY = int(os.environ.get("NVM_AGENT_CONCURRENCY", "16"))
+
+# Time window (in seconds) used to gather incoming events into a single batch
+BATCH_WINDOW = int(os.environ.get("NVM_BATCH_WINDOW_MS", "50")) / 1000
+
+# Limits of a single request packing several translations: number of texts, and output tokens
+# (the output limit of gpt-4o-mini)
+REQUEST_MAX_ITEMS = 10
+REQUEST_MAX_TOKENS = 16384
 
-# Initialize OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Interval (in seconds) between two flushes of the buffered task logs
+LOG_FLUSH_INTERVAL = 0.05
+
+# Model used to embed texts for the semantic translation cache
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Namespace of the translations made with this agent's prompts in the translation cache, the
+# other agents word their prompts differently. Bump the version when one of the prompts changes.
+TRANSLATION_CACHE_NAMESPACE = f"openai:{TRANSLATION_MODEL}:payment-agent-v1"
+
+# OpenAI client, created on first use by get_client()
+_client = None
+
+
+def get_client():
+    """
+    Returns the OpenAI client, creating it on first use.
+
+    The client shares a pool of keep-alive connections across requests. The openai and httpx
+    packages are only imported at that point, which keeps them out of the module import time.
+    """
+    global _client
+    if _client is None:
+        import httpx
+        from openai import AsyncOpenAI
+
+        _client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+                timeout=30,
+            ),
+        )
+    return _client
+
+
+def _max_tokens(text):
+    """
+    Returns the output budget for the translation of a text.
+
+    A translation is about as long as its source, so twice the number of tokens of the
+    text leaves enough room while cutting short a model that goes past the translation.
+    """
+    return min(count_tokens(text, TRANSLATION_MODEL) * 2 + 16, REQUEST_MAX_TOKENS)
+
+
+@functools.lru_cache(maxsize=64)
+def _system_msg(source_lang, target_lang):
+    """
+    Returns the system message for a language pair, built once and reused by every request.
+
+    The same dict is shared across calls, so it must not be modified.
+    """
+    return {"role": "system", "content": f"You are a translator that translates {source_lang} to {target_lang}."}
 
 
 class TranslatorAgent:
@@ -37,6 +104,7 @@ class TranslatorAgent:
 
     Attributes:
         payment (Payments): Instance of the Payments class for task handling and logging.
+        cache (TranslationCache): Cache of previous translations, exact and semantic.
     """
 
     def __init__(self, payment):
@@ -46,22 +114,96 @@ class TranslatorAgent:
         Args:
             payment (Payments): The payment system integration for task and logging management.
         """
+        from utils.translation_cache import TranslationCache
+
         self.payment = payment
+        self.cache = TranslationCache(TRANSLATION_CACHE_NAMESPACE)
+        self._semaphore = asyncio.Semaphore(AGENT_CONCURRENCY)
+        self._tasks = set()  # References to the in-flight batch tasks so they aren't garbage collected
+        self._queue = []  # Events waiting for the current batching window to close
+        self._batch_timer = None
+        self._log_buf = []  # Task logs waiting to be sent by the background flusher
+        self._log_flusher_task = None
+        self._inflight = SingleFlight("Translation")  # Translations in progress by (source_lang, target_lang, text)
+        self.token_usage = {"prompt_tokens": 0, "completion_tokens": 0}  # Of every translation request, reported by close()
 
     async def run(self, data):
         """
         Main entry point for the agent to handle incoming tasks.
+
+        The first event opens a short batching window (NVM_BATCH_WINDOW_MS); every event
+        received until it closes is handed to run_batch, so that their translations are sent
+        in a single request.
+        """
+        self._queue.append(data)
+        if self._batch_timer is None:
+            self._batch_timer = asyncio.get_running_loop().call_later(BATCH_WINDOW, self._drain)
+
+    def _drain(self):
+        """
+        Closes the batching window and processes the gathered events in a background task,
+        so that a slow translation doesn't hold back the following events.
         """
-        step = self.payment.ai_protocol.get_step(data["step_id"])
+        datas, self._queue = self._queue, []
+        self._batch_timer = None
 
-        if not self._is_step_pending(step):
+        task = asyncio.create_task(self._handle(datas))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, datas):
+        """
+        Processes a batch of events, waiting for a free slot if the agent is at full capacity.
+        """
+        async with self._semaphore:
+            await self.run_batch(datas)
+
+    async def run_batch(self, datas):
+        """
+        Translates the input of every pending step of a batch, packing the texts in as few requests as possible.
+
+        Args:
+            datas (list[dict]): The events received during the batching window, each with the
+                step_id, task_id and did of the step to execute.
+        """
+        # The AI protocol only offers a blocking get_step, so the steps are fetched in worker threads
+        steps = await asyncio.gather(
+            *(asyncio.to_thread(self.payment.ai_protocol.get_step, data["step_id"]) for data in datas),
+            return_exceptions=True
+        )
+
+        pending = []
+        for data, step in zip(datas, steps):
+            if isinstance(step, Exception):
+                await self._log_task_error(data["task_id"], f"Could not retrieve the step: {step}")
+            elif self._is_step_pending(step):
+                pending.append((data, step))
+        if not pending:
+            return
+
+        for data, _ in pending:
+            await self._log_task_start(data["task_id"])
+
+        try:
+            translations = await self._translate_texts([step["input_query"] for _, step in pending])
+        except Exception as e:
+            for data, _ in pending:
+                await self._log_task_error(data["task_id"], str(e))
             return
 
-        await self._log_task_start(data["task_id"])
+        # A text that couldn't be translated only fails its own step
+        await asyncio.gather(*(
+            self._log_task_error(data["task_id"], str(translated_text))
+            if isinstance(translated_text, Exception) else self._complete_step(data, translated_text)
+            for (data, _), translated_text in zip(pending, translations)
+        ))
 
+    async def _complete_step(self, data, translated_text):
+        """
+        Stores the translation of a step and logs the completion of its task.
+        """
         try:
-            translated_text = self._translate_text(step["input_query"])
-            self._update_step(data, translated_text)
+            await self._update_step(data, translated_text)
             await self._log_task_completion(data["task_id"])
         except Exception as e:
             await self._log_task_error(data["task_id"], str(e))
@@ -79,33 +221,282 @@ class TranslatorAgent:
         """
         Logs the start of a task.
         """
-        await self.payment.ai_protocol.log_task(TaskLog(
+        self._queue_log(TaskLog(
             task_id=task_id,
             message="Starting translation",
             level="info",
         ))
 
-    def _translate_text(self, input_text, source_lang="Spanish", target_lang="English"):
+    def _queue_log(self, task_log):
+        """
+        Buffers a task log until the next flush, starting the background flusher if needed.
+        """
+        self._log_buf.append(task_log)
+        if self._log_flusher_task is None:
+            self._log_flusher_task = asyncio.create_task(self._log_flusher())
+
+    async def _log_flusher(self):
+        """
+        Sends the buffered task logs every LOG_FLUSH_INTERVAL seconds, until the agent is closed.
+        """
+        while self._log_flusher_task is asyncio.current_task():
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+            await self._flush_logs()
+
+    async def _flush_logs(self):
+        """
+        Sends every buffered task log.
+
+        Logs of different tasks are sent concurrently, while the logs of a single task are
+        sent one after the other so that they keep their order.
+        """
+        logs, self._log_buf = self._log_buf, []
+        logs_by_task = {}
+        for task_log in logs:
+            logs_by_task.setdefault(task_log.task_id, []).append(task_log)
+
+        results = await asyncio.gather(
+            *(self._send_logs(task_logs) for task_logs in logs_by_task.values()),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Error sending task logs: {result}")
+
+    async def _send_logs(self, task_logs):
+        for task_log in task_logs:
+            await self.payment.ai_protocol.log_task(task_log)
+
+    async def close(self):
+        """
+        Stops the background flusher, sends the task logs still buffered and reports the tokens
+        used by the translations.
+        """
+        flusher, self._log_flusher_task = self._log_flusher_task, None
+        if flusher is not None:
+            # Let the flusher finish the logs it may be sending
+            await flusher
+        await self._flush_logs()
+        print(
+            f"Translation token usage: {self.token_usage['prompt_tokens']} prompt, "
+            f"{self.token_usage['completion_tokens']} completion"
+        )
+
+    async def _translate_text(self, input_text, source_lang="Spanish", target_lang="English"):
         """
         Translates the input text using OpenAI's GPT-4 API.
+
+        The output is capped to twice the length of the input, and the completion is
+        streamed and cut short on a blank line that the input doesn't have.
         """
+        stop_at_blank_line = "\n\n" not in input_text
+        max_tokens = _max_tokens(input_text)
         try:
-            response = client.chat.completions.create(
-                model="gpt-4",
+            stream = await get_client().chat.completions.create(
+                model=TRANSLATION_MODEL,
                 messages=[
-                    {"role": "system", "content": f"You are a translator that translates {source_lang} to {target_lang}."},
+                    _system_msg(source_lang, target_lang),
                     {"role": "user", "content": f"Translate the following text: '{input_text}'. Do not generate any additional text beyond the translation."}
                 ],
+                temperature=0,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
             )
-            return response.choices[0].message.content
+            translation = ""
+            try:
+                async for chunk in stream:
+                    if chunk.usage:
+                        self.token_usage["prompt_tokens"] += chunk.usage.prompt_tokens
+                        self.token_usage["completion_tokens"] += chunk.usage.completion_tokens
+                    if not chunk.choices:
+                        continue
+
+                    translation += chunk.choices[0].delta.content or ""
+                    if stop_at_blank_line and "\n\n" in translation:
+                        translation = translation.split("\n\n", 1)[0]
+                        break
+            finally:
+                # Release the connection right away when the stream is cut short
+                await stream.close()
+            return translation
         except Exception as e:
             raise Exception(f"Error during translation: {str(e)}")
 
-    def _update_step(self, data, translated_text):
+    async def _translate_texts(self, input_texts, source_lang="Spanish", target_lang="English"):
+        """
+        Translates several texts, serving repeated or near-identical ones from the cache.
+
+        Exact matches are looked up first. Texts that another request is already translating
+        wait for its result instead of being sent again. The remaining texts are embedded and
+        matched against the semantic cache, and only the texts without a similar cached entry
+        are sent to OpenAI's GPT-4 API.
+
+        Returns:
+            list: The translation of each text, or the exception raised while translating it.
+        """
+        translations = list(await asyncio.gather(
+            *(self.cache.aget(text, source_lang, target_lang) for text in input_texts)
+        ))
+        misses = [i for i, translation in enumerate(translations) if translation is None]
+        if not misses:
+            return translations
+
+        # Claim the texts nobody is translating yet, and wait for the others
+        owned = {}
+        waiting = {}
+        for i in misses:
+            key = (source_lang, target_lang, input_texts[i])
+            future = self._inflight.get(key)
+            if future is not None:
+                waiting[i] = future
+            else:
+                owned[key] = self._inflight.claim(key)
+
+        claimed = [i for i in misses if i not in waiting]
+        try:
+            if claimed:
+                await self._translate_misses(input_texts, claimed, translations, source_lang, target_lang)
+                for i in claimed:
+                    future = owned[(source_lang, target_lang, input_texts[i])]
+                    if isinstance(translations[i], Exception):
+                        future.set_exception(translations[i])
+                    else:
+                        future.set_result(translations[i])
+        except Exception as e:
+            for future in owned.values():
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        finally:
+            for key in owned:
+                self._inflight.release(key)
+
+        for i, future in waiting.items():
+            try:
+                translations[i] = await self._inflight.wait(future)
+            except Exception as e:
+                translations[i] = e
+
+        return translations
+
+    async def _translate_misses(self, input_texts, indexes, translations, source_lang, target_lang):
+        """
+        Fills in the translations of the given texts, from the semantic cache or from OpenAI.
+        """
+        embeddings = await self._embed_texts([input_texts[i] for i in indexes])
+        for i, embedding in zip(indexes, embeddings):
+            if embedding is not None:
+                translations[i] = self.cache.get_similar(embedding, source_lang, target_lang)
+
+        pending = [(i, embedding) for i, embedding in zip(indexes, embeddings) if translations[i] is None]
+        if pending:
+            results = await self._request_translations([input_texts[i] for i, _ in pending], source_lang, target_lang)
+            for (i, _), translation in zip(pending, results):
+                translations[i] = translation
+            await asyncio.gather(*(
+                self.cache.aset(input_texts[i], source_lang, target_lang, translations[i], embedding)
+                for i, embedding in pending if not isinstance(translations[i], Exception)
+            ))
+
+    async def _embed_texts(self, input_texts):
+        """
+        Computes the embeddings used by the semantic cache.
+
+        Returns:
+            list: One embedding per text, or None for every text if the request fails.
+        """
+        try:
+            response = await get_client().embeddings.create(model=EMBEDDING_MODEL, input=input_texts)
+            return [item.embedding for item in response.data]
+        except Exception as e:
+            print(f"Could not compute embeddings, skipping the semantic cache: {e}")
+            return [None] * len(input_texts)
+
+    async def _request_translations(self, input_texts, source_lang="Spanish", target_lang="English"):
+        """
+        Translates several texts with as few requests to OpenAI's GPT-4 API as possible.
+
+        The texts are split in chunks of at most REQUEST_MAX_ITEMS texts, whose translations
+        fit in REQUEST_MAX_TOKENS, and the chunks are sent concurrently.
+
+        Returns:
+            list: The translation of each text, or the exception raised while translating it.
+        """
+        chunks = []
+        chunk, budget = [], 0
+        for text in input_texts:
+            # Room for the translation plus the JSON quoting around it
+            tokens = _max_tokens(text) + 4
+            if chunk and (len(chunk) == REQUEST_MAX_ITEMS or budget + tokens > REQUEST_MAX_TOKENS):
+                chunks.append((chunk, budget))
+                chunk, budget = [], 0
+            chunk.append(text)
+            budget += tokens
+        chunks.append((chunk, budget))
+
+        results = await asyncio.gather(
+            *(self._request_chunk(chunk, min(budget, REQUEST_MAX_TOKENS), source_lang, target_lang)
+              for chunk, budget in chunks)
+        )
+        return [translation for translations in results for translation in translations]
+
+    async def _request_chunk(self, input_texts, max_tokens, source_lang, target_lang):
+        """
+        Translates a chunk of texts with a single request.
+
+        The texts are sent as a numbered list and the model is asked to answer with a JSON
+        object holding the translations in the same order. If the request fails, or if the
+        answer can't be parsed or doesn't match the number of texts, each text is translated
+        individually instead.
+        """
+        if len(input_texts) == 1:
+            return list(await asyncio.gather(
+                self._translate_text(input_texts[0], source_lang, target_lang), return_exceptions=True
+            ))
+
+        numbered_texts = "\n".join(f"{i}. {text}" for i, text in enumerate(input_texts, start=1))
+        try:
+            response = await get_client().chat.completions.create(
+                model=TRANSLATION_MODEL,
+                messages=[
+                    _system_msg(source_lang, target_lang),
+                    {"role": "user", "content": (
+                        "Translate each of the following numbered items. Return a JSON object of the form "
+                        '{"translations": [...]} with one string per item, in the same order. '
+                        "Do not generate any additional text beyond the JSON object.\n"
+                        f"{numbered_texts}"
+                    )}
+                ],
+                response_format={"type": "json_object"},
+                temperature=0,
+                max_tokens=max_tokens,
+            )
+            if response.usage:
+                self.token_usage["prompt_tokens"] += response.usage.prompt_tokens
+                self.token_usage["completion_tokens"] += response.usage.completion_tokens
+            translations = fast_json.loads(response.choices[0].message.content)["translations"]
+            if isinstance(translations, list) and len(translations) == len(input_texts):
+                return [str(translation) for translation in translations]
+        except (fast_json.JSONDecodeError, KeyError, TypeError):
+            pass
+        except Exception as e:
+            print(f"Batched translation failed, translating each text: {e}")
+
+        # Fall back to one concurrent request per text when the batched answer is unusable
+        return list(await asyncio.gather(
+            *(self._translate_text(text, source_lang, target_lang) for text in input_texts),
+            return_exceptions=True,
+        ))
+
+    async def _update_step(self, data, translated_text):
         """
         Updates the step status and adds the translation result.
+
+        The AI protocol only offers a blocking update_step, so it runs in a worker thread.
         """
-        self.payment.ai_protocol.update_step(
+        await asyncio.to_thread(
+            self.payment.ai_protocol.update_step,
             did=data["did"],
             task_id=data["task_id"],
             step_id=data["step_id"],
@@ -123,7 +514,7 @@ class TranslatorAgent:
         """
         Logs the successful completion of a task.
         """
-        await self.payment.ai_protocol.log_task(TaskLog(
+        self._queue_log(TaskLog(
             task_id=task_id,
             message="Translation complete",
             level="info",
@@ -134,7 +525,7 @@ class TranslatorAgent:
         """
         Logs an error encountered during task execution.
         """
-        await self.payment.ai_protocol.log_task(TaskLog(
+        self._queue_log(TaskLog(
             task_id=task_id,
             message=f"Error translating text: {error_message}",
             level="error",
@@ -151,6 +542,11 @@ async def main():
         - Creates a TranslatorAgent instance.
         - Starts the subscription task for the agent.
     """
+    from payments_py import Payments, Environment
+
+    # Serialize the task logs and steps sent by the SDK with orjson
+    fast_json.use_in_payments()
+
     # Initialize the payment system
     payment = Payments(
         app_id="my_first_agent",
@@ -163,23 +559,33 @@ async def main():
     # Create an instance of TranslatorAgent
     agent = TranslatorAgent(payment)
 
-    # Start subscription to handle agent tasks
-    subscription_task = asyncio.get_event_loop().create_task(
-        payment.ai_protocol.subscribe(
-            agent.run,
-            join_account_room=False,
-            join_agent_rooms=[AGENT_DID],
-            get_pending_events_on_subscribe=False
-        )
-    )
+    # Load the tokenizer (downloaded on first use) before the first task comes in
+    await asyncio.to_thread(get_encoding, TRANSLATION_MODEL)
 
     try:
-        # Await the subscription task to handle incoming events
-        await subscription_task
+        # Start subscription to handle agent tasks, and wait for it to handle incoming events
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(
+                payment.ai_protocol.subscribe(
+                    agent.run,
+                    join_account_room=False,
+                    join_agent_rooms=[AGENT_DID],
+                    get_pending_events_on_subscribe=False
+                )
+            )
     except asyncio.CancelledError:
         print("Subscription task was cancelled.")  # Debug: Print cancellation message
+    finally:
+        # Send the task logs that are still buffered
+        await agent.close()
 
 
 # Entry point for the script
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ImportError:
+        # uvloop isn't available on every platform (e.g. Windows)
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
@@ -12,22 +12,25 @@ Functions:
 """
 
 import os
-from dotenv import load_dotenv
+import re
 import asyncio
-from payments_py import Payments, Environment
 from payments_py.utils import generate_step_id
 from payments_py.data_models import AgentExecutionStatus, TaskLog
-from utils.openai_tools import OpenAITools
-from utils.ipfs_helper import IPFSHelper
 
-# Load environment variables from a .env file for secure configuration management
-load_dotenv()
+# Load environment variables from a .env file for secure configuration management when running the agent
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # Constants for API keys and environment setup
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")  # API key for OpenAI GPT-4 integration
 ENVIRONMENT = os.environ.get("NVM_ENVIRONMENT")  # Environment variable for deployment environment
 NVM_API_KEY = os.environ.get("NVM_API_KEY")  # API key for Nevermined system
 AGENT_DID = os.environ.get("AGENT_DID")  # Decentralized Identifier for the agent
+AGENT_CONCURRENCY = int(os.environ.get("NVM_AGENT_CONCURRENCY", "16"))  # Maximum number of steps processed at once
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')  # Splits a streamed translation into sentences
+SPEECH_PIPELINE_TTL = 300  # Seconds a speculative speech pipeline is kept waiting for its text2speech step
 
 
 class TranslatorAgent:
@@ -46,12 +49,32 @@ class TranslatorAgent:
         Args:
             payment (Payments): The payment system integration for task and logging management.
         """
+        from utils.openai_tools import OpenAITools
+
         self.payment = payment
         self.openai_tools = OpenAITools(api_key=OPENAI_API_KEY)
+        self._semaphore = asyncio.Semaphore(AGENT_CONCURRENCY)
+        self._tasks = set()  # References to the in-flight step tasks so they aren't garbage collected
+        self._speech_pipelines = {}  # task_id -> task converting the streamed translation to speech
 
     async def run(self, data):
         """
-        Executes the translation process for a given task.
+        Schedules the execution of a step without blocking the subscription.
+
+        Each step is processed in a background task so that a slow step doesn't hold back
+        the following events. At most NVM_AGENT_CONCURRENCY steps run at the same time.
+
+        Args:
+            data (dict): Dictionary containing task-related information.
+        """
+        task = asyncio.create_task(self._handle(data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, data):
+        """
+        Executes the translation process for a given task, waiting for a free slot if the
+        agent is at full capacity.
 
         Args:
             data (dict): Dictionary containing task-related information:
@@ -62,26 +85,31 @@ class TranslatorAgent:
         Raises:
             Exception: Logs and handles errors encountered during the translation process.
         """
-        # Retrieve the step details for the current task
-        step = self.payment.ai_protocol.get_step(data["step_id"])
-
-        # Validate if the step is pending before proceeding
-        if not self._is_step_pending(step):
-            return
+        async with self._semaphore:
+            # Retrieve the step details for the current task
+            try:
+                step = await asyncio.to_thread(self.payment.ai_protocol.get_step, data["step_id"])
+            except Exception as e:
+                await self._log_task_error(data["task_id"], f"Could not retrieve the step: {e}")
+                return
+
+            # Validate if the step is pending before proceeding
+            if not self._is_step_pending(step):
+                return
         
-        # Handle steps based on their name (init, translate, or text2speech)
-        try:
-            step_name = step["name"]
-            if step_name == "init":
-                await self._handle_init_step(step)
-            elif step_name == "translate":
-                await self._handle_translate_step(data, step)
-            elif step_name == "text2speech":
-                await self._handle_text2speech_step(data, step)
-            else:
-                raise ValueError(f"Unknown step name: {step_name}")
-        except Exception as e:
-            await self._log_task_error(data["task_id"], f"Error processing step '{step_name}': {str(e)}")
+            # Handle steps based on their name (init, translate, or text2speech)
+            try:
+                step_name = step["name"]
+                if step_name == "init":
+                    await self._handle_init_step(step)
+                elif step_name == "translate":
+                    await self._handle_translate_step(data, step)
+                elif step_name == "text2speech":
+                    await self._handle_text2speech_step(data, step)
+                else:
+                    raise ValueError(f"Unknown step name: {step_name}")
+            except Exception as e:
+                await self._log_task_error(data["task_id"], f"Error processing step '{step_name}': {str(e)}")
 
     def _is_step_pending(self, step):
         """
@@ -103,7 +131,9 @@ class TranslatorAgent:
         if output_artifacts:
             update_data["output_artifacts"] = output_artifacts
 
-        self.payment.ai_protocol.update_step(
+        # The AI protocol only offers a blocking update_step, so it runs in a worker thread
+        await asyncio.to_thread(
+            self.payment.ai_protocol.update_step,
             did=step["did"],
             task_id=step["task_id"],
             step_id=step["step_id"],
@@ -164,7 +194,8 @@ class TranslatorAgent:
         ]
 
         # Create new steps in the AI protocol
-        self.payment.ai_protocol.create_steps(
+        await asyncio.to_thread(
+            self.payment.ai_protocol.create_steps,
             current_step["did"],
             current_step["task_id"],
             {"steps": new_steps}
@@ -175,15 +206,96 @@ class TranslatorAgent:
     async def _handle_translate_step(self, data, step):
         """
         Handles the translation step, converting text to the target language.
+
+        The translation is streamed and every completed sentence is converted to speech right
+        away, so that most of the text-to-speech work is done by the time the next step runs.
         """
         await self._log_task_start(data["task_id"], "Starting translation")
 
+        task_id = step["task_id"]
+        sentences = asyncio.Queue()
+        pipeline = asyncio.create_task(self._synthesize_sentences(sentences))
+        self._speech_pipelines[task_id] = pipeline
+        asyncio.get_running_loop().call_later(SPEECH_PIPELINE_TTL, self._drop_speech_pipeline, task_id, pipeline)
+
         try:
-            translated_text = self.openai_tools.translate_text(step["input_query"])
+            translated_text = await self._stream_translation(step["input_query"], sentences)
             await self._complete_step(step, "Translation complete", output=translated_text)
         except Exception as e:
+            self._drop_speech_pipeline(task_id, pipeline)
             raise RuntimeError(f"Translation failed: {str(e)}")
-            
+
+    async def _stream_translation(self, input_text, sentences):
+        """
+        Streams the translation of the input text, queueing each sentence as soon as it's complete.
+
+        The queue is closed with None once the translation is over.
+
+        Returns:
+            str: The complete translation.
+        """
+        translation = ""
+        buffer = ""
+        try:
+            async for delta in self.openai_tools.translate_text_stream(input_text):
+                translation += delta
+                buffer += delta
+                *completed, buffer = SENTENCE_BOUNDARY.split(buffer)
+                for sentence in completed:
+                    sentences.put_nowait(sentence)
+            if buffer.strip():
+                sentences.put_nowait(buffer)
+            return translation
+        finally:
+            sentences.put_nowait(None)
+
+    async def _synthesize_sentences(self, sentences):
+        """
+        Converts each queued sentence to speech as soon as it arrives.
+
+        Returns:
+            tuple: The synthesized text and the mp3 audio of all the sentences.
+        """
+        parts = []
+        speeches = []
+        while (sentence := await sentences.get()) is not None:
+            parts.append(sentence)
+            speeches.append(asyncio.create_task(self.openai_tools.text2speech(sentence)))
+
+        # mp3 frames are self-contained, so the sentences are joined by concatenating their audio
+        audios = await asyncio.gather(*speeches)
+        return " ".join(parts), b"".join(audios)
+
+    def _drop_speech_pipeline(self, task_id, pipeline):
+        """
+        Discards a speech pipeline that won't be used.
+        """
+        if self._speech_pipelines.get(task_id) is pipeline:
+            del self._speech_pipelines[task_id]
+            pipeline.cancel()
+
+    async def _pipelined_speech(self, step):
+        """
+        Returns the audio produced while the translation was streamed, if it matches the text
+        of the step.
+
+        Returns:
+            bytes: The mp3 audio, or None if there is no usable pipeline.
+        """
+        pipeline = self._speech_pipelines.pop(step["task_id"], None)
+        if pipeline is None:
+            return None
+
+        try:
+            text, speech = await pipeline
+        except Exception as e:
+            print(f"Speech pipeline failed, synthesizing the full text: {e}")
+            return None
+
+        if text.split() != (step.get("input_query") or "").split():
+            return None
+        return speech
+
     async def _handle_text2speech_step(self, data, step):
         """
         Handles the text-to-speech step, converting text into an audio file and uploading to IPFS.
@@ -191,8 +303,12 @@ class TranslatorAgent:
         await self._log_task_start(data["task_id"], "Starting text-to-speech")
 
         try:
-            file_speech = self.openai_tools.text2speech(step["input_query"])
-            ipfs_cid = await IPFSHelper.upload_file_to_ipfs(file_speech)
+            speech = await self._pipelined_speech(step)
+            if speech is None:
+                speech = await self.openai_tools.text2speech(step["input_query"])
+            from utils.ipfs_helper import IPFSHelper
+
+            ipfs_cid = await IPFSHelper.upload_bytes_to_ipfs(speech, "text2speech.mp3")
             ipfs_url = IPFSHelper.get_ipfs_url(ipfs_cid)
 
             await self._complete_step(
@@ -213,6 +329,9 @@ async def main():
         - Creates a TranslatorAgent instance.
         - Starts the subscription task for the agent.
     """
+    from payments_py import Payments, Environment
+    from utils.ipfs_helper import IPFSHelper
+
     # Initialize the payment system
     payment = Payments(
         app_id="my_first_agent",
@@ -225,23 +344,32 @@ async def main():
     # Create an instance of TranslatorAgent
     agent = TranslatorAgent(payment)
 
-    # Start subscription to handle agent tasks
-    subscription_task = asyncio.get_event_loop().create_task(
-        payment.ai_protocol.subscribe(
-            agent.run,
-            join_account_room=False,
-            join_agent_rooms=[AGENT_DID],
-            get_pending_events_on_subscribe=False
-        )
-    )
+    # Open the connection to Pinata before the first upload
+    await IPFSHelper.warm_up()
 
     try:
-        # Await the subscription task to handle incoming events
-        await subscription_task
+        # Start subscription to handle agent tasks, and wait for it to handle incoming events
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(
+                payment.ai_protocol.subscribe(
+                    agent.run,
+                    join_account_room=False,
+                    join_agent_rooms=[AGENT_DID],
+                    get_pending_events_on_subscribe=False
+                )
+            )
     except asyncio.CancelledError:
         print("Subscription task was cancelled.")
+    finally:
+        await IPFSHelper.close()
 
 
 # Entry point for the script
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ImportError:
+        # uvloop isn't available on every platform (e.g. Windows)
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
@@ -18,8 +18,8 @@ import asyncio
 from payments_py import Payments, Environment
 from payments_py.utils import generate_step_id
 from payments_py.data_models import AgentExecutionStatus, TaskLog
-from utils.openai_tools import OpenAITools
-import json
+from utils.openai_tools import BatchFailedError, OpenAITools, TruncatedTranslation
+from utils import fast_json
 
 # Load environment variables from a .env file for secure configuration management
 load_dotenv()
@@ -33,6 +33,19 @@ AGENT_DID = os.environ.get("AGENT_DID")  # Decentralized Identifier for the agen
 THIRD_PARTY_PLAN_DID = os.environ.get("THIRD_PARTY_PLAN_DID")  # DID of the third-party agent's plan
 THIRD_PARTY_AGENT_DID = os.environ.get("THIRD_PARTY_AGENT_DID")  # DID of the text-to-speech agent
 
+# Translate through OpenAI's Batch API (half the cost, results within 24h) instead of the real-time endpoint
+BATCH_MODE = os.environ.get("BATCH_MODE", "false").lower() == "true"
+BATCH_SUBMIT_INTERVAL = 60  # Seconds during which translate steps are gathered before being submitted
+BATCH_POLL_INTERVAL = 30  # Seconds between two checks of the submitted batches
+
+# Raw values of the execution statuses compared on every event
+_PENDING_STATUS = AgentExecutionStatus.Pending.value
+_COMPLETED_STATUS = AgentExecutionStatus.Completed.value
+_FAILED_STATUS = AgentExecutionStatus.Failed.value
+
+# Fields of a step, when the event already carries all of them there is no need to fetch it
+_STEP_FIELDS = frozenset(("step_id", "task_id", "did", "name", "step_status", "input_query", "is_last"))
+
 class TranslatorAgent:
     """
     A class to handle text translation tasks using OpenAI's GPT-4 API and delegate tasks like text-to-speech
@@ -52,6 +65,12 @@ class TranslatorAgent:
         """
         self.payment = payment
         self.openai_tools = OpenAITools(api_key=OPENAI_API_KEY)
+        # Translate steps waiting to be submitted, and submitted batches with their steps (BATCH_MODE)
+        self._batch_steps = []
+        self._batches = {}
+        self._batch_worker_task = None
+        self._tasks = set()  # References to the in-flight subtask handlers so they aren't garbage collected
+        self._step_requests = {}  # step_id -> in-flight get_step request, shared by concurrent events
 
     async def run(self, data):
         """
@@ -66,8 +85,8 @@ class TranslatorAgent:
         Raises:
             Exception: Logs and handles errors encountered during task execution.
         """
-        # Retrieve step details from the AI protocol
-        step = self.payment.ai_protocol.get_step(data["step_id"])
+        # Retrieve step details, from the event itself when it carries them
+        step = await self._get_step(data)
 
         # Check if the step is in a pending state
         if not self._is_step_pending(step):
@@ -88,6 +107,33 @@ class TranslatorAgent:
             # Log errors encountered during step processing
             await self._log_task_error(data["task_id"], f"Error processing step '{step_name}': {str(e)}")
 
+    async def _get_step(self, data):
+        """
+        Returns the details of the step an event refers to.
+
+        The event itself is used when it carries the step, otherwise the step is fetched from
+        the AI protocol. Concurrent events for the same step share a single request. Steps are
+        not cached beyond that, a stale status would let a step run twice.
+
+        Args:
+            data (dict): The event received from the subscription.
+
+        Returns:
+            dict: The step details.
+        """
+        if _STEP_FIELDS.issubset(data):
+            return data
+
+        step_id = data["step_id"]
+        request = self._step_requests.get(step_id)
+        if request is None:
+            # The AI protocol API is blocking, so it runs in a worker thread
+            request = asyncio.create_task(asyncio.to_thread(self.payment.ai_protocol.get_step, step_id))
+            self._step_requests[step_id] = request
+            request.add_done_callback(lambda _: self._step_requests.pop(step_id, None))
+        # A cancelled event mustn't cancel the request the other events are waiting for
+        return await asyncio.shield(request)
+
     def _is_step_pending(self, step):
         """
         Checks if a step is in a pending state.
@@ -98,7 +144,7 @@ class TranslatorAgent:
         Returns:
             bool: True if the step is pending, False otherwise.
         """
-        return step['step_status'] == AgentExecutionStatus.Pending.value
+        return step['step_status'] == _PENDING_STATUS
 
     async def _handle_init_step(self, step):
         """
@@ -130,7 +176,8 @@ class TranslatorAgent:
         ]
 
         # Register the steps in the AI protocol
-        self.payment.ai_protocol.create_steps(
+        await asyncio.to_thread(
+            self.payment.ai_protocol.create_steps,
             step["did"],
             step["task_id"],
             {"steps": steps}
@@ -150,9 +197,13 @@ class TranslatorAgent:
         # Log the start of the translation process
         await self._log_task_start(data["task_id"], "Starting translation")
 
+        if BATCH_MODE:
+            await self._queue_batch_translation(step)
+            return
+
         try:
             # Perform the translation using OpenAI tools
-            translated_text = self.openai_tools.translate_text(step["input_query"])
+            translated_text = await self.openai_tools.translate_text(step["input_query"])
 
             # Mark the step as completed with the translation output
             await self._complete_step(step, "Translation complete", output=translated_text)
@@ -160,6 +211,105 @@ class TranslatorAgent:
             # Raise a runtime error if the translation fails
             raise RuntimeError(f"Translation failed: {str(e)}")
 
+    async def _queue_batch_translation(self, step):
+        """
+        Queues a translation step for the Batch API, unless its translation is already cached.
+
+        Args:
+            step (dict): Details of the translation step.
+        """
+        cache = await self.openai_tools.get_translation_cache()
+        cached = await cache.aget(step["input_query"], "Spanish", "English")
+        if cached is not None:
+            await self._complete_step(step, "Translation complete", output=cached)
+            return
+
+        self._batch_steps.append(step)
+        if self._batch_worker_task is None or self._batch_worker_task.done():
+            self._batch_worker_task = asyncio.create_task(self._batch_worker())
+
+    async def _batch_worker(self):
+        """
+        Background loop submitting the queued translation steps as batches, and completing the
+        steps of each batch once its translations are available.
+        """
+        last_submit = asyncio.get_running_loop().time()
+        while self._batch_steps or self._batches:
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            now = asyncio.get_running_loop().time()
+            if self._batch_steps and now - last_submit >= BATCH_SUBMIT_INTERVAL:
+                steps, self._batch_steps = self._batch_steps, []
+                last_submit = now
+                try:
+                    batch_id = await self.openai_tools.translate_batch(
+                        [(step["step_id"], step["input_query"], "Spanish", "English") for step in steps]
+                    )
+                    self._batches[batch_id] = steps
+                except Exception as e:
+                    # The client already retried transient errors, the steps won't be submitted
+                    await self._fail_batch_steps(steps, e)
+
+            for batch_id, steps in list(self._batches.items()):
+                try:
+                    await self._check_batch(batch_id, steps)
+                except Exception as e:
+                    # Transient errors leave the batch in place, it's checked again on the next pass
+                    print(f"Error checking batch {batch_id}: {e}")
+
+    async def _check_batch(self, batch_id, steps):
+        """
+        Completes the steps of a batch if it's finished, or marks them as failed if it failed.
+
+        Args:
+            batch_id (str): Identifier of the batch.
+            steps (list[dict]): The translation steps submitted in the batch.
+        """
+        try:
+            translations = await self.openai_tools.batch_results(batch_id)
+        except BatchFailedError as e:
+            del self._batches[batch_id]
+            await self._fail_batch_steps(steps, e)
+            return
+        if translations is None:
+            return
+
+        cache = await self.openai_tools.get_translation_cache()
+        del self._batches[batch_id]
+
+        async def complete(step):
+            translated_text = translations.get(step["step_id"], "Error: no result returned by the batch")
+            if translated_text.startswith("Error: "):
+                await self._log_task_error(step["task_id"], f"Error processing step 'translate': {translated_text}")
+                return
+            try:
+                if not isinstance(translated_text, TruncatedTranslation):
+                    await cache.aset(step["input_query"], "Spanish", "English", translated_text)
+                await self._complete_step(step, "Translation complete", output=translated_text)
+            except Exception as e:
+                await self._log_task_error(step["task_id"], f"Error processing step 'translate': {str(e)}")
+
+        results = await asyncio.gather(*(complete(step) for step in steps), return_exceptions=True)
+        for step, result in zip(steps, results):
+            if isinstance(result, Exception):
+                # Even the error couldn't be logged on the task
+                print(f"Error completing step {step['step_id']}: {result}")
+
+    async def _fail_batch_steps(self, steps, error):
+        """
+        Logs an error on the task of every translation step of a batch that won't complete.
+
+        Args:
+            steps (list[dict]): The translation steps of the batch.
+            error (Exception): Why the batch won't complete.
+        """
+        results = await asyncio.gather(*(
+            self._log_task_error(step["task_id"], f"Error processing step 'translate': {str(error)}")
+            for step in steps
+        ), return_exceptions=True)
+        for step, result in zip(steps, results):
+            if isinstance(result, Exception):
+                print(f"Error failing step {step['step_id']}: {result}")
+
     async def _handle_text2speech_step(self, data, step):
         """
         Handles the text-to-speech step by delegating it to a third-party agent.
@@ -168,11 +318,12 @@ class TranslatorAgent:
             data (dict): Task data including DID and task_id.
             step (dict): Details of the text-to-speech step.
         """
-        # Log the start of the text-to-speech process
-        await self._log_task_start(data["task_id"], "Starting text-to-speech")
-
-        # Ensure sufficient balance for the third-party agent
-        if not await self._ensure_sufficient_balance(THIRD_PARTY_PLAN_DID):
+        # Log the start of the text-to-speech process while checking the balance for the third-party agent
+        _, has_balance = await asyncio.gather(
+            self._log_task_start(data["task_id"], "Starting text-to-speech"),
+            self._ensure_sufficient_balance(THIRD_PARTY_PLAN_DID),
+        )
+        if not has_balance:
             await self._log_task_error(data["task_id"], "Insufficient balance for third-party plan")
             return
 
@@ -186,10 +337,13 @@ class TranslatorAgent:
 
         # Define a callback to handle the response from the third-party agent
         async def task_callback(callback_data):
-            task_log = json.loads(callback_data)
-            if task_log.get('task_status', None) == AgentExecutionStatus.Completed.value:
-                await self._subtask_finished(task_log["task_id"], step)
-            elif task_log.get('task_status', None) == AgentExecutionStatus.Failed.value:
+            task_log = fast_json.loads(callback_data)
+            if task_log.get('task_status', None) == _COMPLETED_STATUS:
+                # Fetch the subtask result in the background so the callback returns right away
+                task = asyncio.create_task(self._finish_subtask(data["task_id"], task_log["task_id"], step))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            elif task_log.get('task_status', None) == _FAILED_STATUS:
                 await self._log_task_error(data["task_id"], f"Error in subtask: {task_log.get('message', '')}")
             else:
                 await self._log_task(data["task_id"], task_log.get('message', ''), task_log.get('task_status', None))
@@ -214,6 +368,20 @@ class TranslatorAgent:
             # Log an error if the subtask creation fails
             await self._log_task_error(data["task_id"], f"Error creating subtask: {result.text}")
 
+    async def _finish_subtask(self, task_id, subtask_id, step):
+        """
+        Runs _subtask_finished, logging its errors on the main task since nobody awaits it.
+
+        Args:
+            task_id (str): Identifier for the main task.
+            subtask_id (str): Identifier for the subtask.
+            step (dict): Details of the main step.
+        """
+        try:
+            await self._subtask_finished(subtask_id, step)
+        except Exception as e:
+            await self._log_task_error(task_id, f"Error processing step 'text2speech': {str(e)}")
+
     async def _subtask_finished(self, subtask_id, step):
         """
         Handles the completion of a subtask by updating the main step with the results.
@@ -223,20 +391,22 @@ class TranslatorAgent:
             step (dict): Details of the main step.
         """
         # Retrieve the subtask result from the AI protocol
-        subtask_result = self.payment.ai_protocol.get_task_with_steps(THIRD_PARTY_AGENT_DID, subtask_id)
+        subtask_result = await asyncio.to_thread(
+            self.payment.ai_protocol.get_task_with_steps, THIRD_PARTY_AGENT_DID, subtask_id
+        )
         subtask_data = subtask_result.json()
         
         # Determine the status of the subtask
         status = (
-            AgentExecutionStatus.Completed.value
+            _COMPLETED_STATUS
             if subtask_data["task"]["task_status"] == "Completed"
-            else AgentExecutionStatus.Failed.value
+            else _FAILED_STATUS
         )
 
         # Mark the main step as completed or failed with the subtask's output
         return await self._complete_step(
             step,
-            f"Subtask {'completed' if status == AgentExecutionStatus.Completed.value else 'failed'}",
+            f"Subtask {'completed' if status == _COMPLETED_STATUS else 'failed'}",
             output=subtask_data["task"].get("output", ""),
             output_artifacts=subtask_data["task"].get("output_artifacts", [])
         )
@@ -251,12 +421,12 @@ class TranslatorAgent:
         Returns:
             bool: True if sufficient balance is available, False otherwise.
         """
-        # Check the balance for the plan
-        balance = self.payment.get_plan_balance(plan_did)
+        # Check the balance for the plan, the payments API is blocking so it runs in a worker thread
+        balance = await asyncio.to_thread(self.payment.get_plan_balance, plan_did)
 
         # Order additional credits if balance is insufficient
         if int(balance.balance) < 1:
-            response = self.payment.order_plan(plan_did)
+            response = await asyncio.to_thread(self.payment.order_plan, plan_did)
             return response.success
         return True
 
@@ -272,7 +442,7 @@ class TranslatorAgent:
         """
         # Prepare the step update data
         update_data = {
-            "step_status": AgentExecutionStatus.Completed.value,
+            "step_status": _COMPLETED_STATUS,
             "output": output or step.get("input_query"),
             "is_last": step.get("is_last", False),
         }
@@ -280,7 +450,8 @@ class TranslatorAgent:
             update_data["output_artifacts"] = output_artifacts
 
         # Update the step in the AI protocol
-        self.payment.ai_protocol.update_step(
+        await asyncio.to_thread(
+            self.payment.ai_protocol.update_step,
             step["did"],
             step["task_id"],
             step_id=step["step_id"],
@@ -349,12 +520,13 @@ async def main():
     agent = TranslatorAgent(payment)
 
     # Start subscription to handle agent tasks
-    subscription_task = asyncio.get_event_loop().create_task(
+    subscription_task = asyncio.create_task(
         payment.ai_protocol.subscribe(
             agent.run,
             join_account_room=False,
             join_agent_rooms=[AGENT_DID],
-            get_pending_events_on_subscribe=False
+            # Steps still waiting for a batch when the agent stopped are picked up again on restart
+            get_pending_events_on_subscribe=BATCH_MODE
         )
     )
 
@@ -18,6 +18,7 @@ from payments_py import Payments, Environment
 from payments_py.data_models import AgentExecutionStatus, TaskLog
 from utils.openai_tools import OpenAITools
 from utils.ipfs_helper import IPFSHelper
+from utils.single_flight import SingleFlight
 
 # Load environment variables from a .env file for secure configuration management
 load_dotenv()
@@ -28,6 +29,12 @@ OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")  # API key for OpenAI GPT-4 in
 ENVIRONMENT = os.environ.get("NVM_ENVIRONMENT")  # Deployment environment (e.g., dev, staging, production)
 AGENT_DID = os.environ.get("THIRD_PARTY_AGENT_DID")  # Decentralized Identifier (DID) for the agent
 
+# Raw value of the pending status, compared on every event
+_PENDING_STATUS = AgentExecutionStatus.Pending.value
+
+# Fields of a step, when the event already carries all of them there is no need to fetch it
+_STEP_FIELDS = frozenset(("step_id", "task_id", "did", "name", "step_status", "input_query", "is_last"))
+
 
 class Text2SpeechAgent:
     """
@@ -47,6 +54,8 @@ class Text2SpeechAgent:
         """
         self.payment = payment
         self.openai_tools = OpenAITools(api_key=OPENAI_API_KEY)
+        self._inflight = SingleFlight("Text-to-speech")  # Speeches being generated and uploaded, by speech cache key
+        self._step_requests = {}  # step_id -> in-flight get_step request, shared by concurrent events
 
     async def run(self, data):
         """
@@ -58,7 +67,8 @@ class Text2SpeechAgent:
                 - task_id (str): Identifier for the task to execute.
                 - did (str): Decentralized Identifier (DID) of the agent.
         """
-        step = self.payment.ai_protocol.get_step(data["step_id"])
+        # Retrieve step details, from the event itself when it carries them
+        step = await self._get_step(data)
 
         if not self._is_step_pending(step):
             return
@@ -72,6 +82,33 @@ class Text2SpeechAgent:
         except Exception as e:
             await self._log_task_error(data["task_id"], f"Error with Text2Speech: {str(e)}")
 
+    async def _get_step(self, data):
+        """
+        Returns the details of the step an event refers to.
+
+        The event itself is used when it carries the step, otherwise the step is fetched from
+        the AI protocol. Concurrent events for the same step share a single request. Steps are
+        not cached beyond that, a stale status would let a step run twice.
+
+        Args:
+            data (dict): The event received from the subscription.
+
+        Returns:
+            dict: The step details.
+        """
+        if _STEP_FIELDS.issubset(data):
+            return data
+
+        step_id = data["step_id"]
+        request = self._step_requests.get(step_id)
+        if request is None:
+            # The AI protocol API is blocking, so it runs in a worker thread
+            request = asyncio.create_task(asyncio.to_thread(self.payment.ai_protocol.get_step, step_id))
+            self._step_requests[step_id] = request
+            request.add_done_callback(lambda _: self._step_requests.pop(step_id, None))
+        # A cancelled event mustn't cancel the request the other events are waiting for
+        return await asyncio.shield(request)
+
     def _is_step_pending(self, step):
         """
         Validates if the step is in a pending state.
@@ -82,7 +119,7 @@ class Text2SpeechAgent:
         Returns:
             bool: True if the step is pending, False otherwise.
         """
-        return step['step_status'] == AgentExecutionStatus.Pending.value
+        return step['step_status'] == _PENDING_STATUS
 
     async def _process_text2speech(self, input_text):
         """
@@ -95,17 +132,35 @@ class Text2SpeechAgent:
             str: The IPFS URL of the uploaded audio file.
         """
         try:
-            # Convert text to speech
-            file_speech = self.openai_tools.text2speech(input_text)
-
-            # Upload the resulting file to IPFS
-            ipfs_cid = await IPFSHelper.upload_file_to_ipfs(file_speech)
+            # Reuse the speech already uploaded for the same text
+            ipfs_cid = self.openai_tools.get_speech_cid(input_text)
+            if ipfs_cid is None:
+                ipfs_cid = await self._upload_speech(input_text)
             ipfs_url = IPFSHelper.get_ipfs_url(ipfs_cid)
 
             return ipfs_url
         except Exception as e:
             raise RuntimeError(f"Failed to process text-to-speech: {str(e)}")
 
+    async def _upload_speech(self, input_text):
+        """
+        Converts the text to speech and uploads the audio to IPFS.
+
+        Identical texts processed concurrently share a single conversion and upload.
+
+        Returns:
+            str: The CID of the uploaded audio file.
+        """
+        key = self.openai_tools.speech_cache_key(input_text)
+        return await self._inflight.run(key, self._generate_speech, input_text)
+
+    async def _generate_speech(self, input_text):
+        # The audio is only a few hundred KB, buffering it lets a failed upload be retried
+        speech = await self.openai_tools.text2speech(input_text)
+        ipfs_cid = await IPFSHelper.upload_bytes_to_ipfs(speech, "text2speech.mp3")
+        self.openai_tools.cache_speech_cid(input_text, ipfs_cid)
+        return ipfs_cid
+
     async def _update_step(self, data, ipfs_url):
         """
         Updates the step with the IPFS URL and marks it as completed.
@@ -114,7 +169,8 @@ class Text2SpeechAgent:
             data (dict): Task data including DID and task_id.
             ipfs_url (str): The IPFS URL of the uploaded audio file.
         """
-        self.payment.ai_protocol.update_step(
+        await asyncio.to_thread(
+            self.payment.ai_protocol.update_step,
             did=data["did"],
             task_id=data["task_id"],
             step_id=data["step_id"],
@@ -194,8 +250,11 @@ async def main():
     # Create an instance of the Text2SpeechAgent
     agent = Text2SpeechAgent(payment)
 
+    # Open the connection to Pinata before the first upload
+    await IPFSHelper.warm_up()
+
     # Start the subscription task to process incoming events
-    subscription_task = asyncio.get_event_loop().create_task(
+    subscription_task = asyncio.create_task(
         payment.ai_protocol.subscribe(
             agent.run,
             join_account_room=False,
@@ -209,6 +268,8 @@ async def main():
         await subscription_task
     except asyncio.CancelledError:
         print("Subscription task was cancelled.")  # Debug message when task is cancelled
+    finally:
+        await IPFSHelper.close()
 
 
 # Entry point for the script
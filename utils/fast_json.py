@@ -0,0 +1,48 @@
+import json
+import types
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library is used without it
+    orjson = None
+
+if orjson is not None:
+    JSONDecodeError = orjson.JSONDecodeError  # Subclass of json.JSONDecodeError
+
+    def dumps(obj) -> str:
+        """
+        Serializes an object to a JSON string with orjson.
+        """
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(data):
+        """
+        Parses a JSON document with orjson.
+        """
+        return orjson.loads(data)
+else:
+    JSONDecodeError = json.JSONDecodeError
+    dumps = json.dumps
+    loads = json.loads
+
+# Modules of the Nevermined SDK that serialize the task logs and steps sent over the websocket
+PAYMENTS_MODULES = ("payments_py.ai_query_api", "payments_py.nvm_backend")
+
+
+def use_in_payments():
+    """
+    Makes the Nevermined SDK serialize its websocket messages (task logs, steps, subscriptions)
+    with orjson.
+
+    Only the `json` name seen by the SDK modules is replaced, the standard library module used by
+    the rest of the process is left untouched. Does nothing when orjson is not installed.
+    """
+    if orjson is None:
+        return
+
+    import importlib
+    fast = types.SimpleNamespace(dumps=dumps, loads=loads, JSONDecodeError=JSONDecodeError)
+    for name in PAYMENTS_MODULES:
+        module = importlib.import_module(name)
+        if getattr(module, "json", None) is json:
+            module.json = fast
@@ -1,5 +1,7 @@
+import asyncio
 import os
-from pinatapy import PinataPy
+import aiohttp
+import tenacity
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -8,10 +10,42 @@ load_dotenv()
 PINATA_API_KEY = os.getenv('PINATA_API_KEY')
 PINATA_SECRET_API_KEY = os.getenv('PINATA_API_SECRET')
 
-# Connect to Pinata
-pinata = PinataPy(PINATA_API_KEY, PINATA_SECRET_API_KEY)
+PINATA_API_ENDPOINT = "https://api.pinata.cloud"
+_IPFS_PREFIX = "https://gateway.pinata.cloud/ipfs/"  # Public gateway URL, followed by the CID
 
-IPFS_PUBLIC_GATEWAY = "https://gateway.pinata.cloud/ipfs/{CID}"
+# HTTP session shared by every request to Pinata, so that connections are kept alive
+_session = None
+
+
+def get_session():
+    """
+    Returns the HTTP session used to connect to Pinata, creating it on first use.
+
+    Returns:
+        aiohttp.ClientSession: The shared session, authenticated with the Pinata API keys.
+    """
+    global _session
+    if _session is None or _session.closed:
+        # Keep idle connections to Pinata open for a minute so that uploads skip the TLS handshake,
+        # and reuse the resolved address when a new connection has to be opened
+        connector = aiohttp.TCPConnector(limit=32, limit_per_host=16, keepalive_timeout=60, ttl_dns_cache=300)
+        # Bound the time an upload can hang on a stuck connection
+        timeout = aiohttp.ClientTimeout(total=60, connect=5)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers={
+            'pinata_api_key': PINATA_API_KEY or '',
+            'pinata_secret_api_key': PINATA_SECRET_API_KEY or '',
+        })
+    return _session
+
+
+def _is_transient(error):
+    """
+    Tells whether a failed request to Pinata is worth retrying: connection errors, timeouts,
+    rate limiting and server errors.
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
 
 
 class IPFSHelper:
@@ -20,29 +54,66 @@ class IPFSHelper:
     """
 
     @staticmethod
-    async def upload_file_to_ipfs(filename="file.mp3"):
+    async def warm_up():
+        """
+        Opens the connection to Pinata ahead of the first upload.
+
+        The request also checks the API keys, so a misconfiguration shows up at startup.
         """
-        Uploads an file to IPFS through Pinata.
+        try:
+            async with get_session().get(f"{PINATA_API_ENDPOINT}/data/testAuthentication") as response:
+                if response.status != 200:
+                    print(f"Pinata authentication failed: {response.status} {await response.text()}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Timeouts carry no message, the repr at least names the error
+            print(f"Could not connect to Pinata: {e!r}")
+
+    @staticmethod
+    async def close():
+        """
+        Closes the shared connection to Pinata.
+        """
+        global _session
+        if _session is not None and not _session.closed:
+            await _session.close()
+        _session = None
+
+    @staticmethod
+    async def upload_bytes_to_ipfs(data, filename="file.mp3"):
+        """
+        Uploads in-memory content to IPFS through Pinata.
 
         Args:
+            data (bytes): The content to upload.
             filename (str): Name to assign the uploaded file.
 
         Returns:
             str: The CID (content identifier) of the uploaded file.
         """
-
         try:
-            # Upload the file to Pinata
-            result = pinata.pin_file_to_ipfs(filename, save_absolute_paths=False)
-            cid = result['IpfsHash']
-
-            return cid
+            return await IPFSHelper._pin_bytes(data, filename)
         except Exception as e:
             raise Exception(f"Failed to upload file to Pinata: {e}")
-        finally:
-            # Delete the temporary file
-            if os.path.exists(filename):
-                os.remove(filename)
+
+    @staticmethod
+    @tenacity.retry(
+        wait=tenacity.wait_exponential(multiplier=1, max=8),
+        stop=tenacity.stop_after_attempt(4),
+        retry=tenacity.retry_if_exception(_is_transient),
+        reraise=True,
+    )
+    async def _pin_bytes(data, filename):
+        # A form can only be sent once, so every attempt builds its own
+        form = aiohttp.FormData()
+        form.add_field('file', data, filename=filename, content_type='audio/mpeg')
+        return await IPFSHelper._pin_file(form)
+
+    @staticmethod
+    async def _pin_file(form):
+        async with get_session().post(f"{PINATA_API_ENDPOINT}/pinning/pinFileToIPFS", data=form) as response:
+            response.raise_for_status()
+            result = await response.json()
+        return result['IpfsHash']
 
     @staticmethod
     def get_ipfs_url(cid):
@@ -55,4 +126,4 @@ class IPFSHelper:
         Returns:
             str: The public IPFS URL.
         """
-        return IPFS_PUBLIC_GATEWAY.replace("{CID}", cid)
+        return _IPFS_PREFIX + cid
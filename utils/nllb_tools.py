@@ -0,0 +1,100 @@
+import os
+
+NLLB_MODEL_DIR = os.environ.get("NLLB_MODEL_DIR", "nllb-200-distilled-600M-ct2-int8")
+NLLB_TOKENIZER = os.environ.get("NLLB_TOKENIZER", "facebook/nllb-200-distilled-600M")
+
+# NLLB identifies languages with FLORES-200 codes
+NLLB_LANGUAGE_CODES = {
+    "Arabic": "arb_Arab",
+    "Chinese": "zho_Hans",
+    "Dutch": "nld_Latn",
+    "English": "eng_Latn",
+    "French": "fra_Latn",
+    "German": "deu_Latn",
+    "Hindi": "hin_Deva",
+    "Italian": "ita_Latn",
+    "Japanese": "jpn_Jpan",
+    "Korean": "kor_Hang",
+    "Polish": "pol_Latn",
+    "Portuguese": "por_Latn",
+    "Russian": "rus_Cyrl",
+    "Spanish": "spa_Latn",
+    "Turkish": "tur_Latn",
+}
+
+
+class NLLBTranslator:
+    """
+    Local translation backend running a quantized NLLB model with CTranslate2.
+
+    Requires the optional `ctranslate2` and `transformers` packages, and an NLLB model
+    converted to the CTranslate2 format, e.g.:
+
+        ct2-transformers-converter --model facebook/nllb-200-distilled-600M \
+            --quantization int8 --output_dir nllb-200-distilled-600M-ct2-int8
+    """
+
+    def __init__(self, model_dir: str = NLLB_MODEL_DIR, tokenizer_name: str = NLLB_TOKENIZER):
+        try:
+            import ctranslate2
+            import transformers
+        except ImportError as e:
+            raise ImportError(
+                "The NLLB translation backend requires the `ctranslate2` and `transformers` packages: "
+                "pip install ctranslate2 transformers sentencepiece"
+            ) from e
+
+        self.translator = ctranslate2.Translator(model_dir, device="auto", compute_type="int8_float16")
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(tokenizer_name)
+        self._source_skeletons = {}  # language code -> (prefix tokens, suffix tokens)
+
+    def translate_batch(self, texts: list, source_lang: str = "Spanish", target_lang: str = "English") -> list:
+        """
+        Translates a list of texts between two languages.
+
+        Args:
+            texts (list[str]): The texts to translate.
+            source_lang (str): The source language of the texts (default: "Spanish").
+            target_lang (str): The target language for the translations (default: "English").
+
+        Returns:
+            list[str]: The translated texts, in the same order as the input.
+        """
+        target_code = self._language_code(target_lang)
+        prefix, suffix = self._source_skeleton(source_lang)
+
+        # Only the texts themselves are tokenized, the special tokens around them are reused
+        sources = [prefix + self.tokenizer.tokenize(text) + suffix for text in texts]
+        results = self.translator.translate_batch(
+            sources,
+            target_prefix=[[target_code]] * len(sources),
+            max_batch_size=256,
+        )
+
+        # Drop the target language token that prefixes every hypothesis
+        return [
+            self.tokenizer.decode(self.tokenizer.convert_tokens_to_ids(result.hypotheses[0][1:]))
+            for result in results
+        ]
+
+    def _source_skeleton(self, language: str) -> tuple:
+        """
+        Returns the special tokens the tokenizer puts around a text in the given language.
+
+        They only depend on the language, so they are computed once and reused by every call.
+        """
+        code = self._language_code(language)
+        if code not in self._source_skeletons:
+            self.tokenizer.src_lang = code
+            self._source_skeletons[code] = (
+                self.tokenizer.convert_ids_to_tokens(self.tokenizer.prefix_tokens),
+                self.tokenizer.convert_ids_to_tokens(self.tokenizer.suffix_tokens),
+            )
+        return self._source_skeletons[code]
+
+    @staticmethod
+    def _language_code(language: str) -> str:
+        try:
+            return NLLB_LANGUAGE_CODES[language]
+        except KeyError:
+            raise ValueError(f"Unsupported language for the NLLB backend: {language}")
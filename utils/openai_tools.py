@@ -1,26 +1,141 @@
-import tempfile
-from pathlib import Path
-from openai import OpenAI
+import asyncio
+import hashlib
+import os
+import httpx
+from cachetools import LRUCache
+from openai import AsyncOpenAI
+from utils import fast_json
+from utils.single_flight import SingleFlight
+from utils.tokens import count_tokens, get_encoding
+from utils.translation_cache import TranslationCache
+
+TRANSLATION_MODEL = os.environ.get("TRANSLATION_MODEL", "gpt-4o-mini")
+TRANSLATION_BACKEND = os.environ.get("TRANSLATION_BACKEND", "openai")  # "openai" or "nllb" for a local model
+TTS_MODEL = "tts-1"
+TTS_VOICE = "alloy"
+TRANSLATION_BATCH_SIZE = 16  # Maximum number of texts packed in a single translation request
+TRANSLATION_BATCH_WAIT = 0.1  # Seconds a text waits for others to be packed with it
+TRANSLATION_MAX_TOKENS = 16384  # Output limit of a chat completion, bounds the texts packed in a request
+
+class TruncatedTranslation(str):
+    """
+    A translation cut short by its max_tokens budget. It is returned as is, but never cached.
+    """
+
+
+class BatchFailedError(Exception):
+    """
+    Raised when a batch submitted with translate_batch failed, expired or was cancelled.
+    """
+
+
+# OpenAI clients shared by every OpenAITools instance, one per API key
+_clients = {}
+
+
+def _get_client(api_key: str) -> AsyncOpenAI:
+    """
+    Returns the OpenAI client for an API key, creating it on first use.
+
+    The client shares a pool of keep-alive connections across requests and instances.
+    """
+    if api_key not in _clients:
+        _clients[api_key] = AsyncOpenAI(
+            api_key=api_key,
+            # Rate limits, server errors and timeouts are retried with an exponential backoff
+            timeout=30.0,
+            max_retries=3,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            ),
+        )
+    return _clients[api_key]
+
 
 class OpenAITools:
     def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
+        self.client = _get_client(api_key)
+        # Translations are pure functions of the text, repeated texts are served from the cache,
+        # opened on the first translation by get_translation_cache()
+        self._translation_cache = None
+        self._translation_cache_lock = asyncio.Lock()
+        # Names the prompt of _translation_messages, and of the packed and batch requests
+        self._translation_namespace = f"openai:{TRANSLATION_MODEL}:tools-v1"
+        # IPFS CIDs of the speech already generated and uploaded, keyed by speech_cache_key
+        self.speech_cids = LRUCache(maxsize=1024)
+        # Translations in progress by cache key, shared by identical concurrent requests
+        self._inflight_translate = SingleFlight("Translation")
+        # (text, source_lang, target_lang, future) waiting to be packed in a translation request
+        self._pending_translations = []
+        self._flush_timer = None
+        self._tasks = set()  # References to the in-flight translation requests so they aren't garbage collected
+        self.local_translator = None
+        if TRANSLATION_BACKEND == "nllb":
+            from utils.nllb_tools import NLLB_MODEL_DIR, NLLBTranslator
+            self.local_translator = NLLBTranslator()
+            self._translation_namespace = f"nllb:{os.path.basename(os.path.normpath(NLLB_MODEL_DIR))}"
+
+    async def get_translation_cache(self) -> TranslationCache:
+        """
+        Returns the translation cache, opening it on first use.
+
+        Agents that never translate don't open the cache on disk, nor load its entries. The cache
+        is opened in a worker thread so that the event loop isn't blocked meanwhile, along with
+        the tokenizer used to budget the translations (downloaded on first use).
+        """
+        if self._translation_cache is None:
+            async with self._translation_cache_lock:
+                if self._translation_cache is None:
+                    self._translation_cache = await asyncio.to_thread(self._open_translation_cache)
+        return self._translation_cache
+
+    def _open_translation_cache(self) -> TranslationCache:
+        get_encoding(TRANSLATION_MODEL)
+        return TranslationCache(self._translation_namespace)
+
+    async def text2speech(self, input_text: str) -> bytes:
+        """
+        Converts a text to speech.
 
-    def text2speech(self, input_text: str) -> str:
-        response = self.client.audio.speech.create(
-            model='tts-1',
-            voice='alloy',
+        Args:
+            input_text (str): The text to convert to speech.
+
+        Returns:
+            bytes: The mp3 audio, kept in memory rather than written to a temporary file.
+        """
+        response = await self.client.audio.speech.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
             input=input_text,
         )
-        tmp_dir = tempfile.mkdtemp(prefix='text2speech-temp-')
-        speech_file = Path(tmp_dir) / 'text2speech.mp3'
-        response.write_to_file(speech_file)
-        
-        return str(speech_file)
-    
-    def translate_text(self, text: str, source_lang: str = "Spanish", target_lang: str = "English") -> str:
+        return response.content
+
+    @staticmethod
+    def speech_cache_key(input_text: str) -> str:
+        """
+        Builds the key under which the speech of a text is cached.
+
+        Returns:
+            str: A digest of the text-to-speech model, the voice and the text.
+        """
+        return hashlib.blake2b(f"{TTS_MODEL}|{TTS_VOICE}|{input_text}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def get_speech_cid(self, input_text: str):
+        """
+        Returns the IPFS CID of the speech previously uploaded for the text, or None.
+        """
+        return self.speech_cids.get(self.speech_cache_key(input_text))
+
+    def cache_speech_cid(self, input_text: str, cid: str):
+        """
+        Remembers the IPFS CID of the speech uploaded for the text.
+        """
+        self.speech_cids[self.speech_cache_key(input_text)] = cid
+
+    async def translate_text(self, text: str, source_lang: str = "Spanish", target_lang: str = "English") -> str:
         """
-        Translates a given text from one language to another using OpenAI's GPT-4 API.
+        Translates a given text from one language to another using OpenAI's API, or the local
+        NLLB model when TRANSLATION_BACKEND is "nllb".
 
         Args:
             text (str): The text to translate.
@@ -33,15 +148,292 @@ class OpenAITools:
         Raises:
             Exception: Returns an error message if the API call fails.
         """
+        cache = await self.get_translation_cache()
+        cached = await cache.aget(text, source_lang, target_lang)
+        if cached is not None:
+            return cached
+
+        # Wait for the same translation if another request is already running it
+        key = cache.make_key(text, source_lang, target_lang)
+        return await self._inflight_translate.run(key, self._translate_uncached, text, source_lang, target_lang)
+
+    async def _translate_uncached(self, text: str, source_lang: str, target_lang: str) -> str:
+        try:
+            if self.local_translator:
+                translation = await self._translate_locally(text, source_lang, target_lang)
+            else:
+                # Pack the text with the other translations requested meanwhile
+                translation = await self._queue_translation(text, source_lang, target_lang)
+            if not isinstance(translation, TruncatedTranslation):
+                cache = await self.get_translation_cache()
+                await cache.aset(text, source_lang, target_lang, translation)
+            return translation
+        except Exception as e:
+            return f"Error: {str(e)}"
+
+    def _queue_translation(self, text: str, source_lang: str, target_lang: str) -> asyncio.Future:
+        """
+        Queues a text to be translated along with the others queued within TRANSLATION_BATCH_WAIT.
+
+        Returns:
+            asyncio.Future: The future of the translation.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending_translations.append((text, source_lang, target_lang, future))
+        if len(self._pending_translations) >= TRANSLATION_BATCH_SIZE:
+            self._flush_translations()
+        elif self._flush_timer is None:
+            self._flush_timer = loop.call_later(TRANSLATION_BATCH_WAIT, self._flush_translations)
+        return future
+
+    def _flush_translations(self):
+        """
+        Sends the queued texts, with one request per language pair.
+        """
+        items, self._pending_translations = self._pending_translations, []
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        groups = {}
+        for text, source_lang, target_lang, future in items:
+            groups.setdefault((source_lang, target_lang), []).append((text, future))
+        for (source_lang, target_lang), group in groups.items():
+            task = asyncio.create_task(self._send_translations(group, source_lang, target_lang))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send_translations(self, items: list, source_lang: str, target_lang: str):
+        """
+        Translates a group of queued texts and resolves their futures.
+        """
+        try:
+            translations = await self._request_translations([text for text, _ in items], source_lang, target_lang)
+            for (_, future), translation in zip(items, translations):
+                if future.done():
+                    continue
+                if isinstance(translation, Exception):
+                    future.set_exception(translation)
+                else:
+                    future.set_result(translation)
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _request_translations(self, texts: list, source_lang: str, target_lang: str) -> list:
+        """
+        Translates several texts with a single chat completion.
+
+        The texts are sent as a JSON array of {"id", "text"} items and the model answers with
+        the translation of each id. Texts missing from the answer, or all of them if it can't be
+        parsed or the request fails, are translated individually. Groups whose translations
+        wouldn't fit in TRANSLATION_MAX_TOKENS are split in halves sent concurrently.
+
+        Returns:
+            list: The translation of each text, or the exception raised while translating it.
+        """
+        if len(texts) == 1:
+            return list(await asyncio.gather(
+                self._request_translation(texts[0], source_lang, target_lang), return_exceptions=True
+            ))
+
+        # Room for the translations plus the JSON around each of them
+        max_tokens = sum(self._max_tokens(text) + 8 for text in texts)
+        if max_tokens > TRANSLATION_MAX_TOKENS:
+            half = len(texts) // 2
+            first, second = await asyncio.gather(
+                self._request_translations(texts[:half], source_lang, target_lang),
+                self._request_translations(texts[half:], source_lang, target_lang),
+            )
+            return first + second
+
+        items = fast_json.dumps([{"id": i, "text": text} for i, text in enumerate(texts)])
         try:
-            # Make a request to the OpenAI API for translation
-            response = self.client.chat.completions.create(
-                model="gpt-4",
+            response = await self.client.chat.completions.create(
+                model=TRANSLATION_MODEL,
                 messages=[
-                    {"role": "system", "content": f"You are a translator that translates {source_lang} to {target_lang}."},
-                    {"role": "user", "content": f"Translate the following text: '{text}'. Do not generate any additional text beyond the translation."}
+                    {"role": "system", "content": f"Translate {source_lang}→{target_lang}."},
+                    {"role": "user", "content": (
+                        'Translate the "text" of each item. Answer with a JSON object '
+                        '{"translations": [{"id": ..., "text": ...}]} holding one entry per item.\n'
+                        f"{items}"
+                    )}
                 ],
+                response_format={"type": "json_object"},
+                temperature=0,
+                max_tokens=max_tokens,
             )
-            return response.choices[0].message.content  # Extract and return the translation
+            by_id = {
+                int(item["id"]): str(item["text"])
+                for item in fast_json.loads(response.choices[0].message.content)["translations"]
+            }
+        except (fast_json.JSONDecodeError, KeyError, TypeError, ValueError):
+            by_id = {}
         except Exception as e:
-            return f"Error: {str(e)}"
\ No newline at end of file
+            print(f"Packed translation failed, translating each text: {e}")
+            by_id = {}
+
+        missing = [i for i in range(len(texts)) if i not in by_id]
+        if missing:
+            retries = await asyncio.gather(
+                *(self._request_translation(texts[i], source_lang, target_lang) for i in missing),
+                return_exceptions=True,
+            )
+            by_id.update(zip(missing, retries))
+        return [by_id[i] for i in range(len(texts))]
+
+    async def _request_translation(self, text: str, source_lang: str, target_lang: str) -> str:
+        # Make a request to the OpenAI API for translation
+        response = await self.client.chat.completions.create(
+            model=TRANSLATION_MODEL,
+            messages=self._translation_messages(text, source_lang, target_lang),
+            temperature=0,
+            max_tokens=self._max_tokens(text),
+        )
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            return TruncatedTranslation(choice.message.content)
+        return choice.message.content  # Extract the translation
+
+    async def translate_text_stream(self, text: str, source_lang: str = "Spanish", target_lang: str = "English"):
+        """
+        Translates a given text like translate_text, yielding the translation as it is generated.
+
+        Args:
+            text (str): The text to translate.
+            source_lang (str): The source language of the text (default: "Spanish").
+            target_lang (str): The target language for the translation (default: "English").
+
+        Yields:
+            str: The successive chunks of the translated text.
+        """
+        cache = await self.get_translation_cache()
+        cached = await cache.aget(text, source_lang, target_lang)
+        if cached is not None:
+            yield cached
+            return
+
+        if self.local_translator:
+            # The local model doesn't stream, the whole translation comes as a single chunk
+            translation = await self._translate_locally(text, source_lang, target_lang)
+            await cache.aset(text, source_lang, target_lang, translation)
+            yield translation
+            return
+
+        stream = await self.client.chat.completions.create(
+            model=TRANSLATION_MODEL,
+            messages=self._translation_messages(text, source_lang, target_lang),
+            temperature=0,
+            max_tokens=self._max_tokens(text),
+            stream=True,
+        )
+        translation = ""
+        finish_reason = None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            if chunk.choices[0].delta.content:
+                translation += chunk.choices[0].delta.content
+                yield chunk.choices[0].delta.content
+        # Only complete translations are cached
+        if finish_reason != "length":
+            await cache.aset(text, source_lang, target_lang, translation)
+
+    async def translate_batch(self, items: list) -> str:
+        """
+        Submits several translations as a single job to OpenAI's Batch API.
+
+        The Batch API costs half the price of the real-time endpoint, but results can take up
+        to 24h, so it only suits translations that nobody is waiting for.
+
+        Args:
+            items (list[tuple[str, str, str, str]]): The (custom_id, text, source_lang, target_lang)
+                of each translation. The custom_id identifies the translation in the results.
+
+        Returns:
+            str: The identifier of the batch, to pass to batch_results.
+        """
+        # One chat completion request per line of the batch input file
+        lines = [
+            fast_json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": TRANSLATION_MODEL,
+                    "messages": self._translation_messages(text, source_lang, target_lang),
+                    "temperature": 0,
+                    "max_tokens": self._max_tokens(text),
+                },
+            })
+            for custom_id, text, source_lang, target_lang in items
+        ]
+        input_file = await self.client.files.create(
+            file=("translations.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    async def batch_results(self, batch_id: str):
+        """
+        Checks a batch submitted with translate_batch and returns its translations once it's done.
+
+        Returns:
+            dict: The translation of each custom_id, a TruncatedTranslation if it was cut short,
+                or an "Error: ..." message for the requests that failed. None while the batch
+                is still running.
+
+        Raises:
+            BatchFailedError: If the batch failed, expired or was cancelled. Any other error,
+                such as a timeout while checking the batch, leaves the batch to be checked again.
+        """
+        batch = await self.client.batches.retrieve(batch_id)
+        if batch.status in ("failed", "expired", "cancelled"):
+            raise BatchFailedError(f"Batch {batch_id} finished with status '{batch.status}'")
+        if batch.status != "completed":
+            return None
+
+        translations = {}
+        if batch.output_file_id:
+            output = await self.client.files.content(batch.output_file_id)
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                result = fast_json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") == 200:
+                    choice = response["body"]["choices"][0]
+                    translation = choice["message"]["content"]
+                    if choice.get("finish_reason") == "length":
+                        translation = TruncatedTranslation(translation)
+                    translations[result["custom_id"]] = translation
+                else:
+                    translations[result["custom_id"]] = f"Error: {result.get('error') or response.get('body')}"
+        return translations
+
+    async def _translate_locally(self, text: str, source_lang: str, target_lang: str) -> str:
+        # The local model is CPU bound, so it runs in a worker thread
+        translations = await asyncio.to_thread(self.local_translator.translate_batch, [text], source_lang, target_lang)
+        return translations[0]
+
+    @staticmethod
+    def _translation_messages(text: str, source_lang: str, target_lang: str) -> list:
+        # The text is sent as is, quoting it makes the model echo the quotes in the translation
+        return [
+            {"role": "system", "content": f"Translate {source_lang}→{target_lang}. Output only the translation."},
+            {"role": "user", "content": text}
+        ]
+
+    @staticmethod
+    def _max_tokens(text: str) -> int:
+        # A translation is about as long as its source, twice its tokens covers verbose languages.
+        # Tokens are counted rather than words, which scripts without spaces don't have
+        return min(TRANSLATION_MAX_TOKENS, 2 * count_tokens(text, TRANSLATION_MODEL) + 16)
\ No newline at end of file
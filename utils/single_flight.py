@@ -0,0 +1,72 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Shares the result of a computation in progress with the concurrent callers asking for the
+    same key, so that identical requests (translations, speech uploads) run only once.
+
+    Waiters are shielded: a cancelled waiter doesn't cancel the computation the owner and the
+    other waiters depend on.
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): What is computed, used in the error given to waiters if the owner is cancelled.
+        """
+        self.name = name
+        self._futures = {}  # key -> future of the result in progress
+
+    async def run(self, key, func, *args):
+        """
+        Runs `await func(*args)`, or waits for the result of the call already running for the key.
+        """
+        future = self.get(key)
+        if future is not None:
+            return await self.wait(future)
+
+        future = self.claim(key)
+        try:
+            result = await func(*args)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self.release(key)
+
+    def get(self, key):
+        """
+        Returns the future of the result in progress for the key, or None if there is none.
+        """
+        return self._futures.get(key)
+
+    def claim(self, key) -> asyncio.Future:
+        """
+        Registers the caller as computing the result for the key.
+
+        The caller sets the result or the exception of the returned future, then calls release.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._futures[key] = future
+        return future
+
+    def release(self, key):
+        """
+        Forgets the computation of the key, failing its waiters if no result was set.
+        """
+        future = self._futures.pop(key)
+        if not future.done():
+            future.set_exception(RuntimeError(f"{self.name} was cancelled"))
+        # Mark the exception as retrieved, so it isn't reported when nobody was waiting
+        future.exception()
+
+    @staticmethod
+    async def wait(future):
+        """
+        Waits for a result computed by another caller, without cancelling it if the wait is cancelled.
+        """
+        return await asyncio.shield(future)
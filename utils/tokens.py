@@ -0,0 +1,33 @@
+import functools
+
+import tiktoken
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """
+    Returns the tokenizer of a model, loaded once.
+
+    tiktoken downloads the tokenizer on first use. If that fails, None is returned (and
+    cached, so the download isn't attempted again) and token counts are estimated instead.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Model unknown to this version of tiktoken, use the encoding of the current models
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"Could not load the tokenizer, estimating token counts instead: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Counts the tokens of a text for a model.
+
+    Without the tokenizer, the number of tokens is overestimated as one every two characters,
+    which also holds for scripts written without spaces such as Chinese or Japanese.
+    """
+    encoding = get_encoding(model)
+    return len(encoding.encode(text)) if encoding is not None else len(text) // 2
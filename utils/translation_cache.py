@@ -0,0 +1,278 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+import diskcache
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "translator")
+DISK_SIZE_LIMIT = 10 * 2**30  # Maximum size in bytes of the cache on disk
+
+
+class _EmbeddingIndex:
+    """
+    Embeddings of the cached texts of a language pair, updated in place as entries are added
+    and removed, so that a lookup never has to rebuild the matrix.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self._rows = {}  # key -> row of its embedding in the matrix
+        self._matrix = None  # Grown by doubling, only the first len(keys) rows are in use
+
+    def add(self, key, vector):
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self.keys)
+            if self._matrix is None:
+                self._matrix = np.empty((16, vector.shape[0]), dtype=np.float32)
+            elif row == len(self._matrix):
+                self._matrix = np.concatenate([self._matrix, np.empty_like(self._matrix)])
+            self._rows[key] = row
+            self.keys.append(key)
+        self._matrix[row] = vector
+
+    def remove(self, key):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        # Move the last embedding into the freed row
+        last_key = self.keys.pop()
+        if last_key != key:
+            self._matrix[row] = self._matrix[len(self.keys)]
+            self.keys[row] = last_key
+            self._rows[last_key] = row
+
+    def search(self, vector):
+        """
+        Returns the key of the most similar embedding and its similarity.
+        """
+        scores = np.dot(self._matrix[:len(self.keys)], vector)
+        best = int(np.argmax(scores))
+        return self.keys[best], scores[best]
+
+
+class TranslationCache:
+    """
+    Two-tier cache for translations.
+
+    The first tier is an exact-match LRU keyed by (namespace, source language, target language, text).
+    The second tier is a semantic cache: every translation can be stored along with the
+    embedding of its source text, and a lookup returns the translation of the most similar
+    cached text when the cosine similarity is above a threshold. Entries expire after a TTL.
+
+    Both tiers are kept in memory in front of a `diskcache.Cache`, which keeps the cache warm
+    across restarts and can be shared by several replicas through a common volume. The
+    async agents use aget and aset, which read and write the disk in a worker thread.
+    """
+
+    def __init__(self, namespace, maxsize=4096, similarity_threshold=0.95, ttl=7 * 86400, cache_dir=None):
+        """
+        Initializes the cache and loads the most recent entries stored on disk.
+
+        Args:
+            namespace (str): Backend, model and prompt (with its version) producing the
+                translations. It is part of every key: callers prompting the model differently
+                must use different namespaces to keep their translations apart in a shared cache
+                directory, and changing the model or the prompt starts a fresh cache.
+            maxsize (int): Maximum number of translations kept in memory.
+            similarity_threshold (float): Minimum cosine similarity for a semantic hit.
+            ttl (int): Time in seconds after which an entry is considered stale.
+            cache_dir (str): Directory of the cache on disk.
+        """
+        self.maxsize = maxsize
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.namespace = namespace
+        self.directory = cache_dir or os.environ.get("TRANSLATION_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self._disk = diskcache.Cache(self.directory, size_limit=DISK_SIZE_LIMIT)
+        # Keys of the most recently stored entries, loaded at startup to warm the memory tier
+        recent_name = "recent-" + hashlib.sha1(namespace.encode("utf-8")).hexdigest()[:16]
+        self._recent = diskcache.Deque(directory=os.path.join(self.directory, recent_name), maxlen=maxsize)
+
+        # key -> (source_lang, target_lang, translation, embedding, created_at)
+        self._entries = OrderedDict()
+        # (source_lang, target_lang) -> _EmbeddingIndex of the entries stored with an embedding
+        self._indexes = {}
+
+        self._load()
+
+    def make_key(self, text, source_lang, target_lang):
+        """
+        Builds the cache key for a translation.
+
+        Returns:
+            str: The SHA1 hex digest of the namespace, the language pair and the text.
+        """
+        key = f"{self.namespace}|{source_lang}|{target_lang}|{text}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, text, source_lang, target_lang):
+        """
+        Looks up an exact match for the text, in memory first and then on disk.
+
+        Returns:
+            str: The cached translation, or None on a miss.
+        """
+        key = self.make_key(text, source_lang, target_lang)
+        entry = self._get_entry(key)
+        if entry is None:
+            # Entries written by another replica, or evicted from memory
+            entry = self._disk.get(key)
+            if entry is None:
+                return None
+            self._add(key, entry)
+        return entry[2]
+
+    async def aget(self, text, source_lang, target_lang):
+        """
+        Same as get, reading the disk in a worker thread so that the event loop isn't blocked.
+        """
+        key = self.make_key(text, source_lang, target_lang)
+        entry = self._get_entry(key)
+        if entry is None:
+            entry = await asyncio.to_thread(self._disk.get, key)
+            if entry is None:
+                return None
+            self._add(key, entry)
+        return entry[2]
+
+    def get_similar(self, embedding, source_lang, target_lang):
+        """
+        Looks up the translation of the cached text most similar to the given embedding.
+
+        Only the entries held in memory are searched.
+
+        Args:
+            embedding (list[float]): Embedding of the text to translate.
+
+        Returns:
+            str: The cached translation, or None if no cached text is similar enough.
+        """
+        index = self._indexes.get((source_lang, target_lang))
+        vector = self._normalize(embedding)
+        while index is not None and index.keys:
+            key, score = index.search(vector)
+            if score < self.similarity_threshold:
+                return None
+            entry = self._entries[key]
+            if not self._is_expired(entry):
+                return entry[2]
+            # Drop the stale entry and look for the next most similar one
+            self._remove(key)
+        return None
+
+    def set(self, text, source_lang, target_lang, translation, embedding=None):
+        """
+        Stores a translation, optionally with the embedding of its source text.
+        """
+        key, entry = self._make_entry(text, source_lang, target_lang, translation, embedding)
+        self._add(key, entry)
+        self._write(key, entry)
+
+    async def aset(self, text, source_lang, target_lang, translation, embedding=None):
+        """
+        Same as set, writing to disk in a worker thread so that the event loop isn't blocked.
+        """
+        key, entry = self._make_entry(text, source_lang, target_lang, translation, embedding)
+        self._add(key, entry)
+        await asyncio.to_thread(self._write, key, entry)
+
+    def stats(self):
+        """
+        Returns the usage statistics of the cache on disk, to tune its size and TTL.
+
+        Returns:
+            dict: The hits and misses of the disk lookups, the number of entries and the
+                size in bytes of the cache on disk, and the number of entries in memory.
+        """
+        hits, misses = self._disk.stats()
+        return {
+            "disk_hits": hits,
+            "disk_misses": misses,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk.volume(),
+            "memory_entries": len(self._entries),
+        }
+
+    def close(self):
+        """
+        Closes the cache on disk.
+        """
+        self._disk.close()
+        self._recent.cache.close()
+
+    def _make_entry(self, text, source_lang, target_lang, translation, embedding):
+        key = self.make_key(text, source_lang, target_lang)
+        vector = self._normalize(embedding) if embedding is not None else None
+        return key, (source_lang, target_lang, translation, vector, time.time())
+
+    def _write(self, key, entry):
+        self._disk.set(key, entry, expire=self.ttl)
+        self._recent.append(key)
+
+    def _get_entry(self, key):
+        """
+        Returns the entry held in memory for a key, or None if it's missing or has expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._is_expired(entry):
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _add(self, key, entry):
+        # Evict first, so that the embedding indexes never grow past maxsize
+        if key not in self._entries:
+            while len(self._entries) >= self.maxsize:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if entry[3] is not None:
+            self._indexes.setdefault(entry[:2], _EmbeddingIndex()).add(key, entry[3])
+        elif entry[:2] in self._indexes:
+            self._indexes[entry[:2]].remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[:2] in self._indexes:
+            self._indexes[entry[:2]].remove(key)
+
+    def _is_expired(self, entry):
+        return time.time() - entry[4] > self.ttl
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _load(self):
+        """
+        Loads the most recent entries stored on disk, so that the semantic tier starts warm.
+
+        Only the keys of the recent deque are read, the rest of the cache on disk is looked up
+        on demand, so the startup cost doesn't grow with the size of the cache.
+        """
+        keys = []
+        seen = set()
+        for key in reversed(self._recent):
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+
+        # Oldest first, so that the most recent entries end up last in the LRU order
+        for key in reversed(keys):
+            entry = self._disk.get(key)
+            if entry is not None and not self._is_expired(entry):
+                self._add(key, entry)
+
+        # Only count the lookups made once the agent is running
+        self._disk.stats(enable=True, reset=True)